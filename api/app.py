@@ -1,16 +1,30 @@
-import os, re, json, time, logging, secrets, requests
+import os, re, time, heapq, hashlib, logging, secrets, zlib, requests
 import threading
+import orjson
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import islice
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 from flask import Flask, request, Response, stream_with_context, jsonify
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from dotenv import load_dotenv
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from requests.adapters import HTTPAdapter
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 VERSION = "0.1.0"
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Serialize jsonify() responses with orjson; request parsing stays on the stdlib."""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS).decode()
+
 load_dotenv()
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # ----- Env validation -----
 REQUIRED_ENVS = ["CEREBRAS_API_KEY"]
@@ -22,11 +36,28 @@ CEREBRAS_API_KEY = os.getenv("CEREBRAS_API_KEY")
 CEREBRAS_API_URL = "https://api.cerebras.ai/v1/chat/completions"
 ALLOWED_ORIGINS = [o.strip() for o in os.getenv("ALLOWED_ORIGINS", "http://localhost:5173").split(",") if o.strip()]
 RATE_LIMIT = os.getenv("RATE_LIMIT", "30/minute")
+# Shared backend (e.g. redis://redis:6379) so all gunicorn workers count against one limit
+RATELIMIT_STORAGE_URI = os.getenv("RATELIMIT_STORAGE_URI", "memory://")
+# Sliding window avoids the 2x burst a fixed window allows across its boundary
+RATELIMIT_STRATEGY = os.getenv("RATELIMIT_STRATEGY", "moving-window")
+# Number of reverse proxies (e.g. the UI's nginx) whose X-Forwarded-For to trust
+PROXY_COUNT = int(os.getenv("PROXY_COUNT", "0"))
 MAX_FILE_BYTES = int(os.getenv("MAX_FILE_BYTES", "120000"))
+CEREBRAS_POOL_SIZE = int(os.getenv("CEREBRAS_POOL_SIZE", "16"))
+
+# Behind a proxy every request would otherwise share the proxy's address (and rate limit)
+if PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_COUNT, x_proto=PROXY_COUNT)
 
 # CORS + rate limiting
 CORS(app, resources={r"/api/*": {"origins": ALLOWED_ORIGINS}})
-limiter = Limiter(get_remote_address, app=app, default_limits=[RATE_LIMIT])
+limiter = Limiter(
+    get_remote_address,
+    app=app,
+    default_limits=[RATE_LIMIT],
+    storage_uri=RATELIMIT_STORAGE_URI,
+    strategy=RATELIMIT_STRATEGY,
+)
 
 # Logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
@@ -45,29 +76,40 @@ def add_security_headers(response):
 class Metrics:
     def __init__(self):
         self.start_time = time.time()
+        self._lock = threading.Lock()
         self.requests_total = 0
         self.requests_success = 0
         self.requests_error = 0
-        self.response_times = []
+        # Running totals keep get_stats O(1) instead of summing a list that
+        # grows with every request for the lifetime of the process.
+        self.rt_count = 0
+        self.rt_sum = 0.0
 
     def record_request(self, success: bool, response_time: float = 0.0):
-        self.requests_total += 1
-        if success:
-            self.requests_success += 1
-        else:
-            self.requests_error += 1
-        if response_time:
-            self.response_times.append(response_time)
+        # `+=` on attributes is not atomic; the lock is held only for the
+        # handful of integer updates so threaded workers don't lose counts.
+        with self._lock:
+            self.requests_total += 1
+            if success:
+                self.requests_success += 1
+            else:
+                self.requests_error += 1
+            if response_time:
+                self.rt_count += 1
+                self.rt_sum += response_time
 
     def get_stats(self):
+        with self._lock:
+            total, success, errors = self.requests_total, self.requests_success, self.requests_error
+            rt_count, rt_sum = self.rt_count, self.rt_sum
         uptime = time.time() - self.start_time
-        avg_rt = (sum(self.response_times) / len(self.response_times)) if self.response_times else 0.0
-        error_rate = (self.requests_error / self.requests_total * 100.0) if self.requests_total else 0.0
+        avg_rt = (rt_sum / rt_count) if rt_count else 0.0
+        error_rate = (errors / total * 100.0) if total else 0.0
         return {
             "uptime_seconds": round(uptime, 2),
-            "requests_total": self.requests_total,
-            "requests_success": self.requests_success,
-            "requests_error": self.requests_error,
+            "requests_total": total,
+            "requests_success": success,
+            "requests_error": errors,
             "error_rate_percent": round(error_rate, 2),
             "avg_response_time_ms": round(avg_rt * 1000, 1),
             "cache_size": 0  # populated below when cache is created
@@ -83,166 +125,377 @@ def error_response(msg: str, code: int = 400, request_id: str = None):
     return jsonify(payload), code
 
 # ----- Sanitization -----
+BLOCKED_PATTERNS = (
+    "ignore previous", "you are now", "system:", "assistant:",
+    "forget previous", "# system:", "// system:", "human:", "user:", "bot:",
+    "override", "bypass", "admin", "root", "sudo",
+    "new instructions", "disregard", "ignore all",
+    "role-play", "act as", "pretend to be",
+    "developer mode", "debug mode", "unsafe mode"
+)
+# Lines are lower()-ed before matching, so a plain alternation needs no
+# IGNORECASE (which was ~4x slower than the original lower() + `in` loop).
+_BLOCKED_RE = re.compile("|".join(map(re.escape, BLOCKED_PATTERNS)))
+_COMMENT_PREFIXES = ("//", "#", "/*", "*")
+
+def _sanitize(raw: str) -> str:
+    # Drop comment lines (they can carry injection attempts) and blocked phrases.
+    # splitlines() breaks on \r, U+2028 etc. too, so nothing hides behind them.
+    search, comment = _BLOCKED_RE.search, _COMMENT_PREFIXES
+    return "\n".join([
+        line for line in raw.splitlines()
+        if not ((l := line.lower()).lstrip().startswith(comment) or search(l))
+    ])
+
 def sanitize_code(raw: str) -> str:
-    blocked_patterns = (
-        "ignore previous", "you are now", "system:", "assistant:",
-        "forget previous", "# system:", "// system:", "human:", "user:", "bot:",
-        "override", "bypass", "admin", "root", "sudo",
-        "new instructions", "disregard", "ignore all",
-        "role-play", "act as", "pretend to be",
-        "developer mode", "debug mode", "unsafe mode"
-    )
-    out = []
-    for line in raw.splitlines():
-        l = line.lower().strip()
-        # Check for blocked patterns anywhere in line
-        if any(p in l for p in blocked_patterns):
-            continue
-        # Remove comments that might contain injection attempts
-        if l.startswith('//') or l.startswith('#') or l.startswith('/*') or l.startswith('*'):
-            continue
-        out.append(line)
-    return "\n".join(out)
+    # Re-running the same paste in another mode is common, so results are
+    # memoized by a 128-bit content hash rather than by the (large) text itself.
+    # Inputs over the file-size limit are scanned but never retained.
+    if len(raw) > MAX_FILE_BYTES:
+        return _sanitize(raw)
+    key = hashlib.blake2b(raw.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+    clean = sanitize_cache.get(key)
+    if clean is None:
+        clean = _sanitize(raw)
+        sanitize_cache.set(key, clean)
+    return clean
 
 # ----- Prompt builder (simple English, test-friendly) -----
-def get_prompt(mode: str, code: str) -> str:
-    base = (
-        "You are CodeSage.ai, an expert code reviewer. Your audience is a junior developer. "
-        "Use simple English. Use short sentences. Be clear and actionable."
-    )
-    tasks = {
-        "bugs": "Explain each bug: what, why, and how to fix. Include a tiny code example.",
-        "improvements": "Suggest improvements. One-line reason each. Include small before/after when helpful.",
-        "refactor": "Give a small refactor plan. List steps. Name functions/modules. Include a short example.",
-        "explain": "Explain what the code does. Summarize modules and key functions in simple terms.",
-        "performance": "Identify performance bottlenecks. Mention complexity and concrete optimizations.",
-        "security": "Identify security risks and misuse patterns. Provide safe fixes and best practices.",
-        "overview": "Provide a high-level overview and key strengths/risks.",
-        "architecture": "Assess architecture, module boundaries, and coupling. Suggest improvements.",
-    }
-    # Normalize unknown modes to closest category
-    normalized = mode.lower()
-    if normalized not in tasks:
-        if normalized in ("perf", "speed", "latency"):
-            normalized = "performance"
-        elif normalized in ("sec", "vuln", "vulnerability"):
-            normalized = "security"
-        else:
-            normalized = "bugs"
-    t = tasks.get(normalized, tasks["bugs"])
-
-    # Mode-specific instruction skeletons to make outputs distinct
-    skeletons = {
-        "bugs": (
-            "Answer with: TL;DR (3-5 bullets), Findings (one bug per bullet, file/line if possible), "
-            "Fix Steps (ordered, concrete), and a tiny code example showing the fix. Keep examples minimal."
-        ),
-        "improvements": (
-            "Answer with: TL;DR (3-5 bullets), Improvements (each with one-line rationale), "
-            "Before/After snippets when helpful, and optional trade-offs. Avoid rewriting whole files."
-        ),
-        "refactor": (
-            "Answer with: Summary, High-level refactor plan (ordered steps), list of functions/modules to change, "
-            "estimated effort, and a short example showing a refactored function. Emphasize small, safe refactors."
-        ),
-        "explain": (
-            "Answer with: Short summary, what each major function does, and a brief line-by-line explanation for the top 10 lines or the most complex function. Keep it educational."
-        ),
-        "performance": (
-            "Answer with: TL;DR, list of performance hotspots (with Big-O or complexity notes), concrete optimizations, and "
-            "one small code change example to improve speed or memory. Include estimated impact."
-        ),
-        "security": (
-            "Answer with: TL;DR, list of security issues (severity: low/medium/high), exploit example (short), and secure fix steps. Mention input validation and secrets handling."
-        ),
-        "overview": (
-            "Answer with: Short project overview, main responsibilities of files, strengths, weaknesses, and recommended next steps."
-        ),
-        "architecture": (
-            "Answer with: High-level architecture review, coupling/cohesion notes, suggested module boundaries, and migration steps for large changes."
-        ),
-    }
-
-    instr = skeletons.get(normalized, skeletons["bugs"])
-
-    return f"""{base}
-
-Mode: {normalized.upper()}
+PROMPT_BASE = (
+    "You are CodeSage.ai, an expert code reviewer. Your audience is a junior developer. "
+    "Use simple English. Use short sentences. Be clear and actionable."
+)
+PROMPT_TASKS = {
+    "bugs": "Explain each bug: what, why, and how to fix. Include a tiny code example.",
+    "improvements": "Suggest improvements. One-line reason each. Include small before/after when helpful.",
+    "refactor": "Give a small refactor plan. List steps. Name functions/modules. Include a short example.",
+    "explain": "Explain what the code does. Summarize modules and key functions in simple terms.",
+    "performance": "Identify performance bottlenecks. Mention complexity and concrete optimizations.",
+    "security": "Identify security risks and misuse patterns. Provide safe fixes and best practices.",
+    "overview": "Provide a high-level overview and key strengths/risks.",
+    "architecture": "Assess architecture, module boundaries, and coupling. Suggest improvements.",
+}
+# Mode-specific instruction skeletons to make outputs distinct
+PROMPT_SKELETONS = {
+    "bugs": (
+        "Answer with: TL;DR (3-5 bullets), Findings (one bug per bullet, file/line if possible), "
+        "Fix Steps (ordered, concrete), and a tiny code example showing the fix. Keep examples minimal."
+    ),
+    "improvements": (
+        "Answer with: TL;DR (3-5 bullets), Improvements (each with one-line rationale), "
+        "Before/After snippets when helpful, and optional trade-offs. Avoid rewriting whole files."
+    ),
+    "refactor": (
+        "Answer with: Summary, High-level refactor plan (ordered steps), list of functions/modules to change, "
+        "estimated effort, and a short example showing a refactored function. Emphasize small, safe refactors."
+    ),
+    "explain": (
+        "Answer with: Short summary, what each major function does, and a brief line-by-line explanation for the top 10 lines or the most complex function. Keep it educational."
+    ),
+    "performance": (
+        "Answer with: TL;DR, list of performance hotspots (with Big-O or complexity notes), concrete optimizations, and "
+        "one small code change example to improve speed or memory. Include estimated impact."
+    ),
+    "security": (
+        "Answer with: TL;DR, list of security issues (severity: low/medium/high), exploit example (short), and secure fix steps. Mention input validation and secrets handling."
+    ),
+    "overview": (
+        "Answer with: Short project overview, main responsibilities of files, strengths, weaknesses, and recommended next steps."
+    ),
+    "architecture": (
+        "Answer with: High-level architecture review, coupling/cohesion notes, suggested module boundaries, and migration steps for large changes."
+    ),
+}
+# Normalize unknown modes to closest category
+_MODE_ALIASES = {
+    "perf": "performance", "speed": "performance", "latency": "performance",
+    "sec": "security", "vuln": "security", "vulnerability": "security",
+}
+
+# Modes a client may request by name (aliases are only resolved internally)
+REVIEW_MODES = frozenset(PROMPT_TASKS)
+
+# Everything except the code is constant per mode, so render it once at import
+_PROMPT_PREFIXES = {
+    mode: f"""{PROMPT_BASE}
+
+Mode: {mode.upper()}
 
 Task instruction:
-{t}
+{PROMPT_TASKS[mode]}
 
 Required output style:
-{instr}
+{PROMPT_SKELETONS[mode]}
 
 Respond in markdown. Use the following headings where relevant: TL;DR, Findings, Fix Steps, Code Examples, Notes.
 
 Code to review:
 --------------------------------
-{code}
---------------------------------
 """
+    for mode in PROMPT_TASKS
+}
+_PROMPT_SUFFIX = "\n--------------------------------\n"
+
+def _prompt_prefix(mode: str) -> str:
+    normalized = mode.lower()
+    normalized = _MODE_ALIASES.get(normalized, normalized)
+    return _PROMPT_PREFIXES.get(normalized) or _PROMPT_PREFIXES["bugs"]
+
+def get_prompt(mode: str, code: str) -> str:
+    return _prompt_prefix(mode) + code + _PROMPT_SUFFIX
+
+def get_prompt_from_parts(mode: str, parts) -> str:
+    """Like get_prompt, but takes the code as pieces and copies them exactly once."""
+    return "".join([_prompt_prefix(mode), *parts, _PROMPT_SUFFIX])
 
 # ----- GitHub fetch with raw URL conversion -----
+FETCH_CHUNK_BYTES = 64 * 1024
+# One process-wide pool for GitHub fan-out; threads are started lazily and reused
+# across requests instead of spawning a fresh executor per review.
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", "32"))
+fetch_executor = ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE, thread_name_prefix="codesage-fetch")
+# Per-review cap on in-flight downloads, so one long 'urls' list cannot take the whole pool
+MAX_FETCH_WORKERS = 8
+GITHUB_REVALIDATE_SECONDS = 300
+
+# Shared keep-alive pool so repeated GitHub and Cerebras calls skip the TCP+TLS handshake
+http_session = requests.Session()
+# Never smaller than the fetch pool, or extra connections are discarded instead of reused
+http_session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=max(32, THREAD_POOL_SIZE)))
+# Long-lived Cerebras streams get their own pool, sized to one connection per
+# worker thread, so they never crowd out short GitHub downloads.
+http_session.mount("https://api.cerebras.ai/", HTTPAdapter(pool_connections=1, pool_maxsize=CEREBRAS_POOL_SIZE))
+
+GITHUB_BLOB_PREFIX = "https://github.com/"
 RAW_GITHUB_RE = re.compile(r"https://github\.com/(?P<owner>[^/]+)/(?P<repo>[^/]+)/blob/(?P<branch>[^/]+)/(?P<path>.+)")
+REPO_URL_RE = re.compile(r"https?://github\.com/([^/]+)/([^/#?]+)")
 
-def fetch_code(url: str) -> str:
-    m = RAW_GITHUB_RE.match(url.strip())
+def raw_github_url(url: str) -> str:
+    """Map a github.com blob URL to its raw.githubusercontent.com download URL."""
+    # Strip before the cached lookup so whitespace variants share one entry
+    return _raw_github_url(url.strip())
+
+@lru_cache(maxsize=1024)
+def _raw_github_url(u: str) -> str:
+    if not u.startswith(GITHUB_BLOB_PREFIX):
+        raise ValueError("Unsupported GitHub URL. Use a direct blob file URL.")
+    # Fast path: the schema is fixed, so a single split beats running the regex
+    parts = u.split("/", 7)
+    if len(parts) == 8 and parts[5] == "blob" and all(parts[3:]):
+        _, _, _, owner, repo, _, branch, path = parts
+        return f"https://raw.githubusercontent.com/{owner}/{repo}/{branch}/{path}"
+    m = RAW_GITHUB_RE.match(u)
     if not m:
         raise ValueError("Unsupported GitHub URL. Use a direct blob file URL.")
-    raw_url = f"https://raw.githubusercontent.com/{m.group('owner')}/{m.group('repo')}/{m.group('branch')}/{m.group('path')}"
-    with requests.get(raw_url, timeout=15, stream=True) as r:
+    return f"https://raw.githubusercontent.com/{m.group('owner')}/{m.group('repo')}/{m.group('branch')}/{m.group('path')}"
+
+def fetch_raw(raw_url: str, truncate: bool = False) -> str:
+    """Return the sanitized contents of a raw.githubusercontent.com URL (cached per URL).
+
+    Bodies over MAX_FILE_BYTES raise ValueError, or with ``truncate`` are cut short
+    and marked as such.
+    """
+    # Cached entries are served as-is for a short window, then revalidated with
+    # If-None-Match so an unchanged file costs a body-less 304 instead of a download.
+    cached = github_cache.get(raw_url)
+    headers = {}
+    if cached:
+        text, etag, checked_at = cached
+        if time.time() - checked_at < GITHUB_REVALIDATE_SECONDS:
+            return text
+        if etag:
+            headers["If-None-Match"] = etag
+
+    with http_session.get(raw_url, headers=headers, timeout=15, stream=True) as r:
+        if r.status_code == 304 and cached:
+            github_cache.set(raw_url, (cached[0], cached[1], time.time()))
+            return cached[0]
         if r.status_code != 200:
             raise ValueError(f"Fetch failed {r.status_code}")
-        data = r.content
-        if len(data) > MAX_FILE_BYTES:
-            raise ValueError(f"File too large ({len(data)} > {MAX_FILE_BYTES})")
-        return data.decode("utf-8", errors="replace")
+        declared = int(r.headers.get("Content-Length") or 0)
+        if declared > MAX_FILE_BYTES and not truncate:
+            raise ValueError(f"File too large ({declared} > {MAX_FILE_BYTES})")
+        # Read in chunks and stop as soon as the limit is crossed, so an oversized
+        # (or mis-advertised) body is never fully downloaded into memory.
+        buf = bytearray()
+        for chunk in r.iter_content(FETCH_CHUNK_BYTES):
+            buf.extend(chunk)
+            if len(buf) > MAX_FILE_BYTES:
+                if not truncate:
+                    raise ValueError(f"File too large (> {MAX_FILE_BYTES} bytes)")
+                break
+        text = buf.decode("utf-8", errors="replace")
+        if len(buf) > MAX_FILE_BYTES:
+            # Not cached: a later non-truncating fetch of this URL must still fail
+            return _sanitize(text[: MAX_FILE_BYTES // 2] + "\n... (truncated)")
+        # Sanitize once here so cache hits skip the regex pass entirely
+        text = _sanitize(text)
+        github_cache.set(raw_url, (text, r.headers.get("ETag"), time.time()))
+        return text
+
+def fetch_code(url: str) -> str:
+    """Return the sanitized contents of a GitHub blob URL (cached per raw URL)."""
+    return fetch_raw(raw_github_url(url))
+
+def _header_text(text: str) -> str:
+    # Header values are user input that reaches the prompt unsanitized otherwise:
+    # flatten to one line and drop it entirely if it carries a blocked phrase.
+    return _sanitize(" ".join(str(text).split())) or "(removed)"
+
+def fetch_file_part(idx: int, url: str) -> str:
+    """Fetch one file for a multi-file review, reporting failures inline."""
+    label = _header_text(url)
+    try:
+        return f"// File {idx}: {label}\n{fetch_code(url)}"
+    except Exception as fe:
+        return f"// File {idx}: {label} (fetch error: {_header_text(fe)})\n"
 
-# ----- Simple in-memory cache with TTL (used only for health metrics in tests) -----
+# ----- Simple in-memory cache with TTL for fetched GitHub files -----
 class GitHubCache:
     def __init__(self, max_size=100, ttl_seconds=3600):
         self.max_size = max_size
         self.ttl = ttl_seconds
-        self._cache = {}  # key -> (value, expiry)
-    def _is_expired(self, key):
-        item = self._cache.get(key)
-        return (item is None) or (time.time() > item[1])
+        self._lock = threading.Lock()  # guards every mutation, including the LRU touch on a hit
+        self._cache = OrderedDict()  # key -> (value, expiry), least recently used first
+        self._expiries = []  # heap of (expiry, key); overwritten keys leave stale pairs
     def _evict_expired(self):
-        for k in list(self._cache.keys()):
-            if self._is_expired(k):
-                self._cache.pop(k, None)
-        # basic size bound
-        while len(self._cache) > self.max_size:
-            self._cache.pop(next(iter(self._cache)))
+        # Caller holds self._lock
+        now = time.time()
+        heap = self._expiries
+        while heap and heap[0][0] < now:
+            expiry, key = heapq.heappop(heap)
+            item = self._cache.get(key)
+            if item is not None and item[1] == expiry:
+                del self._cache[key]
+        # Rebuild once stale pairs outnumber live entries so the heap stays bounded
+        if len(heap) > 2 * self.max_size:
+            self._expiries = [(exp, k) for k, (_, exp) in self._cache.items()]
+            heapq.heapify(self._expiries)
     def get(self, key):
-        if self._is_expired(key):
-            self._cache.pop(key, None)
+        # Misses are a single atomic dict lookup and skip the lock; hits are
+        # serialized under it because move_to_end reorders the dict.
+        item = self._cache.get(key)
+        if item is None:
             return None
-        return self._cache[key][0]
+        with self._lock:
+            if time.time() > item[1]:
+                if self._cache.get(key) is item:
+                    del self._cache[key]
+                return None
+            if key in self._cache:
+                self._cache.move_to_end(key)
+        return item[0]
     def set(self, key, value):
-        self._cache[key] = (value, time.time() + self.ttl)
-        self._evict_expired()
+        with self._lock:
+            expiry = time.time() + self.ttl
+            self._cache[key] = (value, expiry)
+            self._cache.move_to_end(key)
+            heapq.heappush(self._expiries, (expiry, key))
+            self._evict_expired()
+            # LRU size bound: O(1) pop from the cold end
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
 
 github_cache = GitHubCache()
+# The class itself is a plain TTL/LRU map, so it also backs the caches below
+sanitize_cache = GitHubCache(max_size=256, ttl_seconds=3600)
+# Which branch served each repo's README; kept apart so it never evicts file bodies
+repo_branch_cache = GitHubCache(max_size=256, ttl_seconds=300)
 
 
 # ----- Streaming helpers -----
 HEARTBEAT_INTERVAL = 8
-def _chunk(content: str = "", event: str = "token", done: bool = False) -> str:
+def _chunk(content: str = "", event: str = "token", done: bool = False) -> bytes:
     payload = {"choices": [{"delta": {"content": content}}], "event": event}
     if done:
         payload["done"] = True
-    return f"data: {json.dumps(payload, ensure_ascii=False)}\n"
+    # orjson emits UTF-8 bytes directly, so frames skip the str encode on write.
+    # The blank line terminates the event, as the SSE spec requires.
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+# Token frames differ only in their content, so only that string is JSON-encoded
+_TOKEN_PREFIX = b'data: {"choices":[{"delta":{"content":'
+_TOKEN_SUFFIX = b'}}],"event":"token"}\n\n'
+
+def _token_frame(content: str) -> bytes:
+    return _TOKEN_PREFIX + orjson.dumps(content) + _TOKEN_SUFFIX
+
+# Control frames never change, so they are serialized once at import
+_START_FRAME = _chunk(event="start")
+_HEARTBEAT_FRAME = _chunk(event="heartbeat")
+_END_FRAME = _chunk(event="end", done=True)
+_DONE_FRAME = b"data: [DONE]\n\n"
+
+COALESCE_MAX_BYTES = 4096
+COALESCE_MAX_DELAY = 0.02
+
+def _coalesce(stream, max_bytes: int = COALESCE_MAX_BYTES, max_delay: float = COALESCE_MAX_DELAY):
+    """Merge small SSE frames so the server issues one write per batch, not per token.
+
+    Only token frames are held back. Any other frame (start, heartbeat, end,
+    error, [DONE]) flushes the batch at once, so control events are never delayed.
+    A batch is also flushed once it reaches max_bytes, when a token arrives
+    max_delay or more after the previous flush (so a slow upstream is forwarded
+    token by token), and when the stream ends. Frames stay intact, so clients
+    parsing line by line see the same events.
+    """
+    pending, size, last_flush = [], 0, 0.0
+    for frame in stream:
+        pending.append(frame)
+        size += len(frame)
+        now = time.monotonic()
+        if size >= max_bytes or now - last_flush >= max_delay or not frame.endswith(_TOKEN_SUFFIX):
+            yield b"".join(pending)
+            pending, size, last_flush = [], 0, now
+    if pending:
+        yield b"".join(pending)
+
+def _gzip_stream(stream, level: int = 1):
+    """Gzip an SSE byte stream, sync-flushing after every batch so no token is held back."""
+    gz = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31 selects the gzip container
+    for data in stream:
+        yield gz.compress(data) + gz.flush(zlib.Z_SYNC_FLUSH)
+    yield gz.flush()
+
+def _sse_response(stream) -> Response:
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Vary": "Accept-Encoding"}
+    stream = _coalesce(stream)
+    # Markdown compresses several-fold; gzip batches after coalescing so each
+    # flush covers a whole write rather than a single token.
+    if request.accept_encodings["gzip"]:
+        stream = _gzip_stream(stream)
+        headers["Content-Encoding"] = "gzip"
+    return Response(
+        stream_with_context(stream),
+        mimetype="text/event-stream",
+        headers=headers,
+    )
 
-def cerebras_stream(prompt: str):
+STREAM_READ_BYTES = 4096
+
+def _iter_raw_lines(resp):
+    """Yield upstream lines as raw bytes, split on newlines without decoding them."""
+    buf = bytearray()
+    for chunk in resp.iter_content(STREAM_READ_BYTES):
+        buf.extend(chunk)
+        start = 0
+        while (i := buf.find(b"\n", start)) >= 0:
+            yield bytes(buf[start:i])
+            start = i + 1
+        del buf[:start]
+    if buf:
+        yield bytes(buf)
+
+def cerebras_stream(prompt: str, send_start: bool = True):
+    # Callers that already sent the "start" event pass send_start=False.
     # During tests, return a tiny canned stream to avoid network calls and
     # streaming context complications in the Flask test client.
     if app.config.get('TESTING'):
-        yield _chunk(event="start")
+        if send_start:
+            yield _START_FRAME
         yield _chunk("[TEST MODE] short response", "token")
-        yield _chunk(event="end", done=True)
-        yield "data: [DONE]\n"
+        yield _END_FRAME
+        yield _DONE_FRAME
         return
     headers = {"Authorization": f"Bearer {CEREBRAS_API_KEY}", "Content-Type": "application/json"}
     payload = {
@@ -259,9 +512,12 @@ def cerebras_stream(prompt: str):
     # One retry
     for attempt in (1, 2):
         try:
-            resp = requests.post(CEREBRAS_API_URL, headers=headers, json=payload, stream=True, timeout=120)
+            resp = http_session.post(CEREBRAS_API_URL, headers=headers, json=payload, stream=True, timeout=120)
             if resp.status_code != 200:
-                yield _chunk(f"[API error] {resp.status_code}: {resp.text[:160]}", "error", True)
+                # Read only the first bytes of the error body instead of decoding all of it
+                err = next(resp.iter_content(256), b"").decode("utf-8", "replace")[:160]
+                resp.close()
+                yield _chunk(f"[API error] {resp.status_code}: {err}", "error", True)
                 return
             break
         except Exception as e:
@@ -270,57 +526,69 @@ def cerebras_stream(prompt: str):
                 return
             time.sleep(1.0)
 
-    last_emit = time.time()
-    yield _chunk(event="start")
+    last_emit = time.monotonic()
+    emitted = False
+    tick = 0
     try:
-        for raw in resp.iter_lines(decode_unicode=True):
-            now = time.time()
-            if now - last_emit >= HEARTBEAT_INTERVAL:
-                yield _chunk(event="heartbeat"); last_emit = now
-            if not raw:
-                continue
+        # Inside the try so a disconnect right after "start" still closes resp
+        if send_start:
+            yield _START_FRAME
+        for raw in _iter_raw_lines(resp):
+            # Sample the clock once per 64 upstream lines rather than on every
+            # token; at streaming rates that is far finer than the heartbeat.
+            tick += 1
+            if not tick & 63:
+                now = time.monotonic()
+                if emitted:
+                    last_emit, emitted = now, False
+                elif now - last_emit >= HEARTBEAT_INTERVAL:
+                    yield _HEARTBEAT_FRAME; last_emit = now
             line = raw.strip()
-            if line.startswith("data:"):
+            if not line:
+                continue
+            if line.startswith(b"data:"):
                 line = line[5:].strip()
-            if line == "[DONE]":
+            if line == b"[DONE]":
                 break
             sent = False
-            if line.startswith("{") and line.endswith("}"):
-                try:
-                    obj = json.loads(line)
-                    # If the object contains streaming choices, extract only content pieces.
-                    # If there are no content pieces (metadata like role/id/etc.), skip silently.
-                    if isinstance(obj, dict):
-                        if "choices" in obj:
-                            acc = ""
-                            for c in obj.get("choices", []):
-                                delta = (c or {}).get("delta") or {}
-                                piece = delta.get("content", "")
-                                if piece:
-                                    acc += piece
-                            if acc:
-                                yield _chunk(acc, "token")
-                                last_emit = time.time()
-                                sent = True
-                            else:
-                                # metadata-only choices (e.g. role markers) -> ignore
-                                sent = True
-                        else:
-                            # Generic JSON metadata from provider (not useful to clients) -> ignore
-                            sent = True
-                except json.JSONDecodeError:
-                    # If it isn't valid JSON after all, fall back to emitting the raw line below
-                    pass
+            try:
+                obj = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                # Not JSON after all: fall back to emitting the raw line below
+                obj = None
+            # If the object contains streaming choices, extract only content pieces.
+            # If there are no content pieces (metadata like role/id/etc.), skip silently.
+            if isinstance(obj, dict):
+                if "choices" in obj:
+                    acc = ""
+                    for c in obj.get("choices", []):
+                        delta = (c or {}).get("delta") or {}
+                        piece = delta.get("content", "")
+                        if piece:
+                            acc += piece
+                    if acc:
+                        yield _token_frame(acc)
+                        emitted = True
+                        sent = True
+                    else:
+                        # metadata-only choices (e.g. role markers) -> ignore
+                        sent = True
+                else:
+                    # Generic JSON metadata from provider (not useful to clients) -> ignore
+                    sent = True
             if not sent:
-                yield _chunk(line, "token")
-                last_emit = time.time()
+                yield _token_frame(line.decode("utf-8", "replace"))
+                emitted = True
     except GeneratorExit:
+        # Client disconnected; no more frames can be sent
         return
     except Exception as e:
         yield _chunk(f"[Stream error] {e}", "error")
     finally:
-        yield _chunk(event="end", done=True)
-        yield "data: [DONE]\n"
+        # Hand the keep-alive connection back to the pool (or drop it if unread)
+        resp.close()
+    yield _END_FRAME
+    yield _DONE_FRAME
 
 # ----- Routes -----
 @app.route("/api/review", methods=["POST"])
@@ -335,8 +603,7 @@ def review():
     mode = (body.get("mode") or "bugs").lower()
 
     # Validate mode early: reject clearly invalid user-provided modes
-    allowed_modes = {"bugs", "improvements", "refactor", "explain", "performance", "security", "overview", "architecture"}
-    if body.get("mode") and mode not in allowed_modes:
+    if body.get("mode") and mode not in REVIEW_MODES:
         metrics.record_request(False)
         return error_response("Invalid mode", 400, request_id)
 
@@ -346,54 +613,68 @@ def review():
         # Tests expect messages mentioning 'Missing'
         return error_response("Missing 'code' or 'url' (or 'urls' array)", 400, request_id)
 
-    try:
-        aggregated_code = ""
+    target_urls = []
+    if not code_input:
+        if urls and isinstance(urls, list):
+            target_urls.extend([u for u in urls if isinstance(u, str) and u.strip()])
+        if url and isinstance(url, str):
+            target_urls.append(url)
+        if not target_urls:
+            metrics.record_request(False)
+            return error_response("No valid URL(s) provided", 400, request_id)
+
+    def review_stream():
+        # Fetching and prompt building happen here, after the response headers and
+        # "start" event are out, so slow GitHub downloads never hold up the reply.
+        yield _START_FRAME
+        # Inputs are sanitized per source (fetched files already are), so the
+        # headers we add below are not re-scanned, or stripped as comments.
+        # Code is handed over as pieces so the prompt is the only full copy made.
         if code_input:
-            aggregated_code = f"// Provided code snippet\n{code_input}"
+            code_parts = ["// Provided code snippet\n", sanitize_code(str(code_input))]
         else:
-            target_urls = []
-            if urls and isinstance(urls, list):
-                target_urls.extend([u for u in urls if isinstance(u, str) and u.strip()])
-            if url and isinstance(url, str):
-                target_urls.append(url)
-            if not target_urls:
-                raise ValueError("No valid URL(s) provided")
-            parts = []
-            for idx, u in enumerate(target_urls, start=1):
-                try:
-                    content = fetch_code(u)
-                    parts.append(f"// File {idx}: {u}\n{content}")
-                except Exception as fe:
-                    parts.append(f"// File {idx}: {u} (fetch error: {fe})\n")
-            aggregated_code = "\n\n".join(parts)
-
-        clean_code = sanitize_code(aggregated_code)
-        prompt = get_prompt(mode, clean_code)
-    except Exception as e:
-        metrics.record_request(False)
-        return error_response(str(e), 400, request_id)
+            # Sliding window of MAX_FETCH_WORKERS downloads; if the client goes away
+            # the generator is closed and the URLs not yet started are never fetched.
+            queued = iter(enumerate(target_urls, start=1))
+            futures, pending = [], set()
+            last_beat = time.monotonic()
+            try:
+                while True:
+                    for idx, u in islice(queued, MAX_FETCH_WORKERS - len(pending)):
+                        f = fetch_executor.submit(fetch_file_part, idx, u)
+                        futures.append(f)
+                        pending.add(f)
+                    if not pending:
+                        break
+                    _, pending = wait(pending, timeout=HEARTBEAT_INTERVAL, return_when=FIRST_COMPLETED)
+                    if time.monotonic() - last_beat >= HEARTBEAT_INTERVAL:
+                        last_beat = time.monotonic()
+                        yield _HEARTBEAT_FRAME
+            finally:
+                for f in pending:
+                    f.cancel()
+            code_parts = []
+            for f in futures:
+                if code_parts:
+                    code_parts.append("\n\n")
+                code_parts.append(f.result())
+        yield from cerebras_stream(get_prompt_from_parts(mode, code_parts), send_start=False)
 
     # In testing mode, avoid returning a streaming generator Response because
     # the Flask test client may not fully drain the generator which can leave
     # request contexts in an inconsistent state. Instead, collect the stream
-    # into a single string and return it synchronously.
+    # into a list and return it synchronously.
     if app.config.get('TESTING'):
-        parts = []
-        for piece in cerebras_stream(prompt):
-            parts.append(piece)
-        content = "".join(parts)
+        parts = list(review_stream())
         resp = Response(
-            content,
+            parts,
             mimetype="text/event-stream",
             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
         )
     else:
-        resp = Response(
-            stream_with_context(cerebras_stream(prompt)),
-            mimetype="text/event-stream",
-            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
-        )
-    metrics.record_request(True, time.time() - t0)
+        resp = _sse_response(review_stream())
+    # Record once the stream is closed so response_time covers the whole answer
+    resp.call_on_close(lambda: metrics.record_request(True, time.time() - t0))
     return resp
 
 @app.route("/api/analyze-repo", methods=["POST"])
@@ -413,28 +694,37 @@ def analyze_repo():
         return error_response("Missing 'repository_url'", 400, request_id)
 
     # Parse owner/repo from URL like https://github.com/owner/repo[.git][/...]
-    m = re.match(r"https?://github\.com/([^/]+)/([^/#?]+)", repo_url)
+    m = REPO_URL_RE.match(repo_url)
     if not m:
         metrics.record_request(False)
         return error_response("Unsupported repository URL", 400, request_id)
     owner, repo = m.group(1), m.group(2).replace(".git", "")
 
     def stream_repo():
-        yield _chunk(event="start")
-        branches = ["main", "master"]
+        yield _START_FRAME
+        candidates = [f"https://raw.githubusercontent.com/{owner}/{repo}/{br}/README.md" for br in ("main", "master")]
+        # Remember which branch had the README so a mode switch on the same repo
+        # goes straight to it instead of re-probing a branch that 404s.
+        repo_key = f"{owner}/{repo}"
+        known = repo_branch_cache.get(repo_key)
+        if known in candidates:
+            candidates.remove(known)
+            candidates.insert(0, known)
         tried = []
         content = None
-        for br in branches:
-            raw = f"https://raw.githubusercontent.com/{owner}/{repo}/{br}/README.md"
+        for raw in candidates:
             tried.append(raw)
             try:
-                r = requests.get(raw, timeout=15)
-                if r.status_code == 200 and r.content:
-                    content = r.content.decode("utf-8", errors="replace")
-                    break
+                # Shares fetch_code's cache, so re-running a repo in another mode
+                # costs at most a conditional GET per README.
+                content = fetch_raw(raw, truncate=True)
             except Exception:
-                pass
-        if not content:
+                continue
+            # Found means the download succeeded; the sanitized text may be empty
+            # (e.g. a README of only "#" headings) and that is not a miss.
+            repo_branch_cache.set(repo_key, raw)
+            break
+        if content is None:
             msg = (
                 "Could not fetch README.md from the repository (tried: "
                 + ", ".join(tried)
@@ -442,41 +732,49 @@ def analyze_repo():
             )
             # Still return as a valid SSE stream, not a 400
             yield _chunk(msg, event="token")
-            yield _chunk(event="end", done=True)
-            yield "data: [DONE]\n"
+            yield _END_FRAME
+            yield _DONE_FRAME
             return
 
-        # Limit to a reasonable size
-        if len(content.encode("utf-8")) > MAX_FILE_BYTES:
-            content = content[: MAX_FILE_BYTES // 2] + "\n... (truncated)"
-
-        prompt = get_prompt(mode, sanitize_code(content))
-        for piece in cerebras_stream(prompt):
-            yield piece
+        prompt = get_prompt(mode, content)
+        yield from cerebras_stream(prompt, send_start=False)
 
-    resp = Response(
-        stream_with_context(stream_repo()),
-        mimetype="text/event-stream",
-        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
-    )
-    metrics.record_request(True, time.time() - t0)
+    resp = _sse_response(stream_repo())
+    # Record once the stream is closed so response_time covers the whole answer
+    resp.call_on_close(lambda: metrics.record_request(True, time.time() - t0))
     return resp
 
+# Monitors may poll health every second; build the payload at most once per window
+HEALTH_TTL_SECONDS = 1.0
+_health_memo = (None, 0.0)  # (serialized body, built_at monotonic)
+
+def _health_body() -> bytes:
+    global _health_memo
+    body, built_at = _health_memo
+    now = time.monotonic()
+    if body is None or now - built_at >= HEALTH_TTL_SECONDS:
+        stats = metrics.get_stats()
+        stats["cache_size"] = len(github_cache._cache)
+        payload = {
+            "status": "ok",
+            "version": VERSION,
+            "metrics": stats,
+            "cache": {
+                "enabled": True,
+                "size": stats["cache_size"],
+                "max_size": github_cache.max_size,
+                "ttl_seconds": github_cache.ttl
+            }
+        }
+        body = orjson.dumps(payload)
+        # Swapping the whole tuple keeps concurrent readers from seeing a torn pair
+        _health_memo = (body, now)
+    return body
+
 @app.route("/api/health")
 def health():
-    stats = metrics.get_stats()
-    stats["cache_size"] = len(github_cache._cache)
-    return jsonify({
-        "status": "ok",
-        "version": VERSION,
-        "metrics": stats,
-        "cache": {
-            "enabled": True,
-            "size": len(github_cache._cache),
-            "max_size": github_cache.max_size,
-            "ttl_seconds": github_cache.ttl
-        }
-    })
+    # Already-serialized bytes: skip jsonify and the JSON provider entirely
+    return Response(_health_body(), mimetype="application/json")
 
 
 
@@ -492,4 +790,6 @@ def internal_error(e):
     return error_response("Unexpected server error. Please try again.", 500)
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    # Development server only; set FLASK_DEBUG=1 for the reloader/debugger.
+    # Production runs under gunicorn (see Dockerfile).
+    app.run(host="0.0.0.0", port=5000, threaded=True)
@@ -1,16 +1,21 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime, timezone
-import json
+import orjson
 
 db = SQLAlchemy()
 
+_UTC = timezone.utc
+
+def _utcnow():
+    return datetime.now(_UTC)
+
 class User(db.Model):
     __tablename__ = 'users'
 
     id = db.Column(db.Integer, primary_key=True)
     session_id = db.Column(db.String(255), unique=True, nullable=False)
-    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
-    last_activity = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+    created_at = db.Column(db.DateTime, default=_utcnow)
+    last_activity = db.Column(db.DateTime, default=_utcnow, onupdate=_utcnow)
 
     # User preferences
     theme = db.Column(db.String(20), default='auto')  # light, dark, auto
@@ -39,6 +44,8 @@ class User(db.Model):
 
 class Analysis(db.Model):
     __tablename__ = 'analyses'
+    # Serves "latest analyses for a user" as an index range scan, no sort step
+    __table_args__ = (db.Index('ix_analyses_user_created', 'user_id', 'created_at'),)
 
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -67,7 +74,7 @@ class Analysis(db.Model):
     error_message = db.Column(db.Text)
 
     # Timestamps
-    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    created_at = db.Column(db.DateTime, default=_utcnow)
     completed_at = db.Column(db.DateTime)
 
     def to_dict(self):
@@ -80,9 +87,9 @@ class Analysis(db.Model):
             'file_count': self.file_count,
             'total_files': self.total_files,
             'total_lines': self.total_lines,
-            'languages': json.loads(self.languages) if self.languages else [],
+            'languages': orjson.loads(self.languages) if self.languages else [],
             'repository_url': self.repository_url,
-            'file_paths': json.loads(self.file_paths) if self.file_paths else [],
+            'file_paths': orjson.loads(self.file_paths) if self.file_paths else [],
             'processing_time_ms': self.processing_time_ms,
             'ai_response_time_ms': self.ai_response_time_ms,
             'cache_hit': self.cache_hit,
@@ -97,7 +104,7 @@ class AnalyticsSnapshot(db.Model):
     __tablename__ = 'analytics_snapshots'
 
     id = db.Column(db.Integer, primary_key=True)
-    timestamp = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    timestamp = db.Column(db.DateTime, default=_utcnow)
 
     # System metrics
     total_users = db.Column(db.Integer, default=0)
@@ -126,7 +133,7 @@ class AnalyticsSnapshot(db.Model):
             'avg_response_time_ms': self.avg_response_time_ms,
             'error_rate_percent': self.error_rate_percent,
             'cache_hit_rate_percent': self.cache_hit_rate_percent,
-            'popular_input_modes': json.loads(self.popular_input_modes) if self.popular_input_modes else {},
-            'popular_analysis_modes': json.loads(self.popular_analysis_modes) if self.popular_analysis_modes else {},
-            'popular_languages': json.loads(self.popular_languages) if self.popular_languages else {}
+            'popular_input_modes': orjson.loads(self.popular_input_modes) if self.popular_input_modes else {},
+            'popular_analysis_modes': orjson.loads(self.popular_analysis_modes) if self.popular_analysis_modes else {},
+            'popular_languages': orjson.loads(self.popular_languages) if self.popular_languages else {}
         }